@@ -1,28 +1,84 @@
 #!/usr/bin/env python3
 import sys
 import os.path
+import atexit
+import signal
+import threading
+import queue
 from time import time, sleep, localtime, strftime
 import logging
 import argparse
 from configparser import ConfigParser
-from collections import OrderedDict
 from pyLoraRFM9x import LoRa, ModemConfig
 import paho.mqtt.client as mqtt
-import json
-import jsonpickle
+import orjson
 import struct
-from messages import DiscoveryMsg, MsgType, PingMsg, ValueMsg, ConfigItem, Cover
+from messages import DiscoveryMsg, MsgType, PingMsg, ValueMsg, ConfigItem
 
 PROJECT_NAME = "LoRa2MQTT Gateway Client/Daemon"
 PROJECT_VERSION = "0.0.1"
 PROJECT_URL = "https://github.com/ovenystas/lora2mqtt"
 
+# The message type is in the low nibble of the LoRa header flags
+MSG_TYPE_MASK = 0x0F
+
+# Maximum number of state messages waiting to be published to MQTT
+PUBLISH_QUEUE_SIZE = 256
+# Values from one device received within this many seconds are published together
+VALUE_PUBLISH_DELAY = 0.1
+# Longest time to wait for queued state messages to be published at shutdown
+PUBLISH_DRAIN_TIMEOUT = 10
+
+# Payloads of the messages sent to devices
+RSSI_PACKER = struct.Struct("!h")
+ENTITY_ID_PACKER = struct.Struct("!B")
+SERVICE_REQ_PACKER = struct.Struct("!BB")
+
+DISCOVERY_FILE_PATH = "discovery.json"
+# Changes to the discovered entities are written to file at most this often
+DISCOVERY_SAVE_DELAY = 5
+
+CONFIG_DEFAULTS = {
+    "Daemon": {
+        "enabled": "True",
+        "period": "300",
+    },
+    "MQTT": {
+        "base_topic": "lora2mqtt",
+        "discovery_prefix": "homeassistant",
+        "discovery_qos": "1",
+    },
+}
+
 config = None
 devices = None
 lora = None
 
-discovery_msgs = list()
+# Settings used for every message, read from config once in load_configuration()
+base_topic = None
+discovery_prefix = None
+discovery_qos = None
+
+# Discovered entities as entity_id: DiscoveryMsg
+discovery_msgs = dict()
+# Built discovery messages as (device_id, entity_id): (topic, payload)
+discovery_payloads = dict()
+# Last discovery payload published to each discovery topic in this session
+published_discoveries = dict()
+discovery_save_timer = None
+# Held while the save timer is changed and while the discovery file is written
+discovery_save_lock = threading.Lock()
+# (topic, payload) of state messages, published by mqtt_publisher_loop()
+publish_queue = queue.Queue(maxsize=PUBLISH_QUEUE_SIZE)
+# Values not yet published as device_id: {entity_name: value}
+pending_values = dict()
+pending_values_lock = threading.Lock()
+pending_values_timer = None
+# Set by the signal handler to stop the daemon
+shutdown_event = threading.Event()
 mqtt_client = mqtt.Client()
+# Set on the first successful connect, so later connects are known to be reconnects
+mqtt_connected_once = False
 
 
 class CustomFormatter(logging.Formatter):
@@ -42,9 +98,19 @@ class CustomFormatter(logging.Formatter):
         logging.CRITICAL: bold_red + format + reset,
     }
 
+    FORMATS_NO_COLOR = dict.fromkeys(FORMATS, format)
+
+    def __init__(self, color=True):
+        super().__init__()
+        formats = self.FORMATS if color else self.FORMATS_NO_COLOR
+        self._formatters = {
+            level: logging.Formatter(log_fmt) for level, log_fmt in formats.items()
+        }
+        # For custom log levels, same as a Formatter without format string
+        self._default_formatter = logging.Formatter()
+
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt)
+        formatter = self._formatters.get(record.levelno, self._default_formatter)
         return formatter.format(record)
 
 
@@ -52,7 +118,8 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 console_handler = logging.StreamHandler()
 console_handler.setLevel(logging.DEBUG)
-console_handler.setFormatter(CustomFormatter())
+# No color escape sequences when logging to a pipe, file or the journal
+console_handler.setFormatter(CustomFormatter(color=console_handler.stream.isatty()))
 logger.addHandler(console_handler)
 
 
@@ -80,8 +147,7 @@ def parse_arguments():
 
 
 def print_intro():
-    print(f"{PROJECT_NAME} v{PROJECT_VERSION}")
-    print("Source:", PROJECT_URL)
+    print(f"{PROJECT_NAME} v{PROJECT_VERSION}\nSource: {PROJECT_URL}")
 
 
 def on_mqtt_connect(client, userdata, flags, rc):
@@ -89,8 +155,13 @@ def on_mqtt_connect(client, userdata, flags, rc):
     Eclipse Paho callback on MQTT connection
     http://www.eclipse.org/paho/clients/python/docs/#callbacks
     """
+    global mqtt_connected_once
     if rc == 0:
         logger.info("MQTT connection established")
+        # On the first connect mqtt_discovery_announce_all() publishes everything
+        if mqtt_connected_once:
+            mqtt_discovery_republish()
+        mqtt_connected_once = True
     else:
         logger.error("MQTT connect error")
         os._exit(1)
@@ -115,9 +186,11 @@ def load_configuration(config_file_path):
     """
     Load configuration file
     """
-    global config
+    global config, base_topic, discovery_prefix, discovery_qos
     config = ConfigParser(delimiters=("=",), inline_comment_prefixes=("#"))
     config.optionxform = str
+    # Defaults first, anything set in the configuration file overrides them
+    config.read_dict(CONFIG_DEFAULTS)
     try:
         with open(config_file_path) as config_file:
             config.read_file(config_file)
@@ -125,18 +198,26 @@ def load_configuration(config_file_path):
         logger.error(f"Configuration file {config_file_path} not found")
         sys.exit(1)
 
-    config["Daemon"]["enabled"] = config["Daemon"].get("enabled", "True")
-    config["MQTT"]["base_topic"] = config["MQTT"].get("base_topic", "lora2mqtt").lower()
-    config["MQTT"]["discovery_prefix"] = (
-        config["MQTT"].get("discovery_prefix", "homeassistant").lower()
-    )
-    config["Daemon"]["period"] = config["Daemon"].get("period", "300")
+    for option in ("base_topic", "discovery_prefix"):
+        config["MQTT"][option] = config["MQTT"][option].lower()
+
+    base_topic = config["MQTT"]["base_topic"]
+    discovery_prefix = config["MQTT"]["discovery_prefix"]
+    try:
+        discovery_qos = config["MQTT"].getint("discovery_qos")
+    except ValueError:
+        logger.error(f"Invalid discovery_qos {config['MQTT']['discovery_qos']}")
+        sys.exit(1)
 
 
 def check_configuration():
     """
     Check configuration
     """
+    if discovery_qos not in (0, 1, 2):
+        logger.error(f"Invalid discovery_qos {discovery_qos}, must be 0, 1 or 2")
+        sys.exit(1)
+
     logger.info("Configuration accepted")
 
 
@@ -187,124 +268,160 @@ def mqtt_connect():
 def load_devices(devices_file_path):
     logger.info(f"Loading devices from {devices_file_path} ...")
     global devices
-    with open(devices_file_path) as devices_file:
-        devices = json.load(devices_file)
+    with open(devices_file_path, mode="rb") as devices_file:
+        devices_json = orjson.loads(devices_file.read())
+
+    # JSON object keys are strings but addresses and entity ids arrive as ints
+    devices = {int(id): device for id, device in devices_json.items()}
+
+    # The device block and topics are the same for all entities of a device
+    for device in devices.values():
+        if device["entities"]:
+            device["entities"] = {
+                int(id): name for id, name in device["entities"].items()
+            }
+            # Keys of the entities in the state payload
+            device["_state_keys"] = {
+                id: name.lower() for id, name in device["entities"].items()
+            }
+        device["_name_lower"] = device["name"].lower()
+        device_topic = f"{base_topic}/{device['_name_lower']}"
+        device["_discovery_device"] = mqtt_create_discovery_device(device)
+        device["_state_topic"] = f"{device_topic}/state"
+        device["_command_topic"] = f"{device_topic}/set"
+
     logger.info("...devices loaded")
 
 
-def mqtt_create_discovery_cover(device: dict, entity: DiscoveryMsg):
-    base_topic = config["MQTT"].get("base_topic")
+def mqtt_create_discovery_device(device: dict):
     device_name = device["name"]
-    entity_name = device["entities"][str(entity.entity_id)]
-    unique_id = f"{device_name.lower()}_{entity_name.lower()}"
-
-    payload = OrderedDict()
-    payload["name"] = entity_name
-    payload["device_class"] = entity.device_class
-    payload["unique_id"] = unique_id
-    payload["object_id"] = unique_id
-    payload["device"] = {
+
+    return {
         "name": device_name,
-        "identifiers": [f"lora2mqtt_{device_name.lower()}"],
+        "identifiers": [f"lora2mqtt_{device['_name_lower']}"],
         "manufacturer": "Ove Nystas",
         "model": "LoRaNodeGarage",
     }
-    payload["state_topic"] = f"{base_topic}/{device_name.lower()}/state"
-    payload["command_topic"] = f"{base_topic}/{device_name.lower()}/set"
-    payload["value_template"] = f"{{{{ value_json.{entity_name.lower()} }}}}"
 
-    logger.debug(jsonpickle.encode(payload, unpicklable=False))
-
-    return payload
 
+def mqtt_create_discovery_common(device: dict, entity: DiscoveryMsg):
+    """
+    The part of a discovery payload that is the same for all components.
+    """
+    entity_name = device["entities"][entity.entity_id]
+    entity_name_lower = device["_state_keys"][entity.entity_id]
+    unique_id = f"{device['_name_lower']}_{entity_name_lower}"
 
-def mqtt_create_discovery_binary_sensor(device: dict, entity: DiscoveryMsg):
-    base_topic = config["MQTT"].get("base_topic")
-    device_name = device["name"]
-    entity_name = device["entities"][str(entity.entity_id)]
-    unique_id = f"{device_name.lower()}_{entity_name.lower()}"
-
-    payload = OrderedDict()
-    payload["name"] = entity_name
-    payload["device_class"] = entity.device_class
-    payload["unique_id"] = unique_id
-    payload["object_id"] = unique_id
-    payload["device"] = {
-        "name": device_name,
-        "identifiers": [f"lora2mqtt_{device_name.lower()}"],
-        "manufacturer": "Ove Nystas",
-        "model": "LoRaNodeGarage",
+    return {
+        "name": entity_name,
+        "device_class": entity.device_class,
+        "unique_id": unique_id,
+        "object_id": unique_id,
+        "device": device["_discovery_device"],
+        "state_topic": device["_state_topic"],
+        "value_template": f"{{{{ value_json.{entity_name_lower} }}}}",
     }
-    payload["state_topic"] = f"{base_topic}/{device_name.lower()}/state"
-    payload["value_template"] = f"{{{{ value_json.{entity_name.lower()} }}}}"
+
+
+def mqtt_create_discovery_cover(device: dict, entity: DiscoveryMsg):
+    payload = mqtt_create_discovery_common(device, entity)
+    payload["command_topic"] = device["_command_topic"]
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(orjson.dumps(payload).decode())
 
     return payload
 
 
+def mqtt_create_discovery_binary_sensor(device: dict, entity: DiscoveryMsg):
+    return mqtt_create_discovery_common(device, entity)
+
+
 def mqtt_create_discovery_sensor(device: dict, entity: DiscoveryMsg):
-    base_topic = config["MQTT"].get("base_topic")
-    device_name = device["name"]
-    entity_name = device["entities"][str(entity.entity_id)]
-    unique_id = f"{device_name.lower()}_{entity_name.lower()}"
-
-    payload = OrderedDict()
-    payload["name"] = entity_name
-    payload["device_class"] = entity.device_class
-    payload["unique_id"] = unique_id
-    payload["object_id"] = unique_id
-    payload["device"] = {
-        "name": device_name,
-        "identifiers": [f"lora2mqtt_{device_name.lower()}"],
-        "manufacturer": "Ove Nystas",
-        "model": "LoRaNodeGarage",
-    }
-    payload["state_topic"] = f"{base_topic}/{device_name.lower()}/state"
+    payload = mqtt_create_discovery_common(device, entity)
     payload["unit_of_measurement"] = entity.unit
-    payload["value_template"] = f"{{{{ value_json.{entity_name.lower()} }}}}"
-    payload["suggested_display_precision "] = entity.precision
+    payload["suggested_display_precision"] = entity.precision
     payload["state_class"] = "measurement"
 
     return payload
 
 
-def mqtt_discovery_announce_entity(device: dict, entity: DiscoveryMsg):
+MQTT_DISCOVERY_BUILDERS = {
+    "cover": mqtt_create_discovery_cover,
+    "binary_sensor": mqtt_create_discovery_binary_sensor,
+    "sensor": mqtt_create_discovery_sensor,
+}
+
+
+def mqtt_create_discovery_msg(device: dict, entity: DiscoveryMsg):
     """
-    Discovery Announcement of one entity in one device.
+    Build the discovery topic and serialized payload of one entity in one device.
+    Returns None if the component is not supported.
     """
-    discovery_prefix = config["MQTT"].get("discovery_prefix")
-    entity_name = device["entities"][str(entity.entity_id)]
-    discovery_topic = f"{discovery_prefix}/{entity.component}/{device['name'].lower()}/{entity_name.lower()}/config"
+    entity_name_lower = device["_state_keys"][entity.entity_id]
+    discovery_topic = f"{discovery_prefix}/{entity.component}/{device['_name_lower']}/{entity_name_lower}/config"
 
     payload = None
-    if entity.component == "cover":
-        payload = mqtt_create_discovery_cover(device, entity)
-    elif entity.component == "binary_sensor":
-        payload = mqtt_create_discovery_binary_sensor(device, entity)
-    elif entity.component == "sensor":
-        payload = mqtt_create_discovery_sensor(device, entity)
-    else:
+    create = MQTT_DISCOVERY_BUILDERS.get(entity.component)
+    if create is None:
         logger.warning(f"Discovery for {entity.component} is not implemented.")
-
-    if payload:
-        mqtt_client.publish(discovery_topic, json.dumps(payload), 1, True)
-        logger.info(f"Published entity {entity_name} to {discovery_topic}")
     else:
+        payload = create(device, entity)
+
+    if not payload:
         logger.warning("No discovery payload to publish.")
+        return None
+
+    return discovery_topic, orjson.dumps(payload)
+
+
+def mqtt_discovery_announce_entity(id: int, device: dict, entity: DiscoveryMsg):
+    """
+    Discovery Announcement of one entity in one device.
+    Returns the MQTTMessageInfo of the publish, or None if nothing was published.
+    """
+    key = (id, entity.entity_id)
+    discovery_msg = discovery_payloads.get(key)
+    if discovery_msg is None:
+        discovery_msg = mqtt_create_discovery_msg(device, entity)
+        if discovery_msg is None:
+            return None
+        discovery_payloads[key] = discovery_msg
+
+    discovery_topic, payload_bytes = discovery_msg
+    entity_name = device["entities"][entity.entity_id]
+    if published_discoveries.get(discovery_topic) == payload_bytes:
+        logger.debug(f"Entity {entity_name} already published to {discovery_topic}")
+        return None
+
+    msg_info = mqtt_client.publish(
+        discovery_topic,
+        payload_bytes,
+        discovery_qos,
+        True,
+    )
+    if msg_info.rc == mqtt.MQTT_ERR_SUCCESS:
+        published_discoveries[discovery_topic] = payload_bytes
+    logger.info(f"Published entity {entity_name} to {discovery_topic}")
+    return msg_info
 
 
-def mqtt_discovery_announce_device(id: int, device: dict):
+def mqtt_discovery_announce_device(id: int, device: dict) -> list:
     """
     Discovery Announcement of one device.
+    Returns the MQTTMessageInfo of every publish without waiting for them.
     """
     logger.info(
         f"Announcing LoRa device {id}:{device['name']} to MQTT broker for auto-discovery ..."
     )
 
-    if id == 1:  # Only have discovery messages for id 1 now
-        for entity in discovery_msgs:
-            mqtt_discovery_announce_entity(device, entity)
-    else:
-        logger.warning(f"Device {id} has no discovery")
+    msg_infos = list()
+    for entity in discovery_msgs.values():
+        msg_info = mqtt_discovery_announce_entity(id, device, entity)
+        if msg_info:
+            msg_infos.append(msg_info)
+
+    return msg_infos
 
 
 def mqtt_discovery_announce_all():
@@ -313,12 +430,135 @@ def mqtt_discovery_announce_all():
     """
     logger.info("Announcing All LoRa devices to MQTT broker for auto-discovery ...")
 
+    announced = list()
     for id, device in devices.items():
-        mqtt_discovery_announce_device(int(id), device)
+        if id == 1:  # Only have discovery messages for id 1 now
+            announced.append((id, device))
+        else:
+            logger.warning(f"Device {id} has no discovery")
+
+    # Publish everything first and wait for the acks afterwards, so the PUBACKs
+    # of all retained discovery messages are in flight at the same time.
+    # paho holds back QoS > 0 messages beyond 20 in flight by default, the
+    # raised limit also applies to all later publishes.
+    mqtt_client.max_inflight_messages_set(max(20, len(announced) * len(discovery_msgs)))
+    msg_infos = list()
+    for id, device in announced:
+        msg_infos.extend(mqtt_discovery_announce_device(id, device))
+
+    for msg_info in msg_infos:
+        if msg_info.rc == mqtt.MQTT_ERR_SUCCESS:
+            msg_info.wait_for_publish(timeout=5)
 
     logger.info("All LoRa devices announced to MQTT broker")
 
 
+def mqtt_discovery_republish():
+    """
+    Republish every discovery payload announced so far, as cached, since the
+    broker may have lost its retained messages while we were disconnected.
+    """
+    cached = list(published_discoveries.items())
+    if not cached:
+        return
+
+    logger.info(f"Republishing {len(cached)} discovery messages ...")
+    for discovery_topic, payload_bytes in cached:
+        mqtt_client.publish(discovery_topic, payload_bytes, discovery_qos, True)
+
+
+def mqtt_queue_publish(topic: str, payload):
+    """
+    Queue a state message for mqtt_publisher_loop(), without blocking the caller.
+    """
+    try:
+        publish_queue.put_nowait((topic, payload))
+    except queue.Full:
+        logger.error(f"Publish queue is full, dropping message to {topic}")
+
+
+def mqtt_publisher_loop():
+    """
+    Publish queued state messages and wait for them to be acknowledged.
+    Runs in its own thread so broker latency never holds up LoRa reception.
+    """
+    while True:
+        topic, payload = publish_queue.get()
+        logger.info(f"Publishing to {topic} ...")
+
+        msg_info = mqtt_client.publish(topic, payload=payload, qos=1, retain=False)
+        if msg_info.rc == mqtt.MQTT_ERR_SUCCESS:
+            msg_info.wait_for_publish(timeout=5)
+            logger.info("...done")
+        elif msg_info.rc == mqtt.MQTT_ERR_NO_CONN:
+            logger.error("...no connection")
+        elif msg_info.rc == mqtt.MQTT_ERR_QUEUE_SIZE:
+            logger.error("...send queue is full")
+        else:
+            logger.error("...unknown error")
+
+        publish_queue.task_done()
+
+
+def mqtt_schedule_publish_values(device_id: int, values: dict):
+    """
+    Publish the values of a device after VALUE_PUBLISH_DELAY seconds, merged
+    with any other values of that device received in the meantime
+    """
+    global pending_values_timer
+    with pending_values_lock:
+        pending_values.setdefault(device_id, dict()).update(values)
+        if pending_values_timer is None:
+            pending_values_timer = threading.Timer(
+                VALUE_PUBLISH_DELAY, mqtt_publish_pending_values
+            )
+            pending_values_timer.daemon = True
+            pending_values_timer.start()
+
+
+def mqtt_publish_pending_values():
+    """
+    Queue one state message per device with all of its pending values
+    """
+    global pending_values, pending_values_timer
+    with pending_values_lock:
+        pending = pending_values
+        pending_values = dict()
+        pending_values_timer = None
+
+    for device_id, values in pending.items():
+        state_payload = orjson.dumps(values)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(state_payload.decode())
+
+        mqtt_queue_publish(devices[device_id]["_state_topic"], state_payload)
+
+
+def mqtt_flush_pending_values():
+    """
+    Queue the pending values right away instead of waiting for the timer
+    """
+    with pending_values_lock:
+        timer = pending_values_timer
+        if timer is not None:
+            timer.cancel()
+
+    mqtt_publish_pending_values()
+
+
+def mqtt_drain_publish_queue(timeout: float):
+    """
+    Wait at most timeout seconds for all queued state messages to be published
+    """
+    drain = threading.Thread(target=publish_queue.join, daemon=True)
+    drain.start()
+    drain.join(timeout)
+    if drain.is_alive():
+        logger.warning(
+            f"{publish_queue.unfinished_tasks} state messages not published before shutdown"
+        )
+
+
 def on_lora_receive(payload):
     """
     Callback function that runs when a LoRa message is received
@@ -330,194 +570,203 @@ def on_lora_receive(payload):
 
 
 def lora_load_discovery():
-    file_name = "discovery.json"
+    file_name = DISCOVERY_FILE_PATH
     try:
-        with open(file_name) as f:
-            disc_json = json.load(f)
+        with open(file_name, mode="rb") as f:
+            disc_json = orjson.loads(f.read())
             for item in disc_json:
                 disc_msg = DiscoveryMsg.from_dict(item)
-                discovery_msgs.append(disc_msg)
+                discovery_msgs[disc_msg.entity_id] = disc_msg
     except FileNotFoundError as e:
         logger.warning(f"Could not find file {file_name}, will create a new")
-    except json.decoder.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         logger.warning(
             f"Failed to decode file {file_name}, perform a new discovery to recreate it"
         )
 
 
+def lora_save_discovery():
+    """
+    Write all discovered entities to the discovery file
+    """
+    global discovery_save_timer
+    with discovery_save_lock:
+        discovery_save_timer = None
+        items = [item.to_dict() for item in list(discovery_msgs.values())]
+        # Replace the file in one step, so it is never left half written
+        temp_file_path = f"{DISCOVERY_FILE_PATH}.tmp"
+        with open(temp_file_path, mode="wb") as f:
+            f.write(orjson.dumps(items))
+        os.replace(temp_file_path, DISCOVERY_FILE_PATH)
+    logger.debug(f"Saved {len(items)} entities to {DISCOVERY_FILE_PATH}")
+
+
+def lora_schedule_save_discovery():
+    """
+    Save the discovered entities after DISCOVERY_SAVE_DELAY seconds, so a burst
+    of discovery messages results in one write
+    """
+    global discovery_save_timer
+    with discovery_save_lock:
+        if discovery_save_timer is None:
+            discovery_save_timer = threading.Timer(
+                DISCOVERY_SAVE_DELAY, lora_save_discovery
+            )
+            discovery_save_timer.daemon = True
+            discovery_save_timer.start()
+
+
+def lora_flush_discovery():
+    """
+    Write pending changes to the discovered entities right away.
+    Waits for a save that is already being written to finish.
+    """
+    with discovery_save_lock:
+        timer = discovery_save_timer
+        if timer is None:
+            return
+        timer.cancel()
+
+    lora_save_discovery()
+
+
+def log_debug_message(message: bytes):
+    """
+    Log a raw LoRa message as hex. Skips the hex formatting unless debug logging
+    is enabled, since this runs for every received message.
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(bytes.hex(message, " "), stacklevel=2)
+
+
 def lora_parse_msg(payload):
-    if str(payload.header_from) not in devices.keys():
+    if payload.header_from not in devices:
         logger.warning(f"LoRa msg from unknown device {payload.header_from}")
-        logger.debug(bytes.hex(payload.message, " "))
+        log_debug_message(payload.message)
         return
 
-    MSG_TYPE_MASK = 0x0F
     msg_type = payload.header_flags & MSG_TYPE_MASK
     logger.info(f"msg_type: {msg_type}")
 
-    if msg_type == int(MsgType.PING_REQ):
-        logger.info("Got a ping request")
-        lora_parse_ping_req(payload)
-    elif msg_type == int(MsgType.PING_MSG):
-        logger.info("Got a ping message")
-        lora_parse_ping_msg(payload)
-    elif msg_type == int(MsgType.DISCOVERY_REQ):
-        logger.info("Got a discovery request")
-        lora_parse_discovery_req(payload)
-    elif msg_type == int(MsgType.DISCOVERY_MSG):
-        logger.info("Got a discovery message")
-        lora_parse_discovery_msg(payload)
-    elif msg_type == int(MsgType.VALUE_REQ):
-        logger.info("Got a value request")
-        lora_parse_value_req(payload)
-    elif msg_type == int(MsgType.VALUE_MSG):
-        logger.info("Got a value message")
-        lora_parse_value_msg(payload)
-    elif msg_type == int(MsgType.CONFIG_REQ):
-        logger.info("Got a config request")
-        lora_parse_config_req(payload)
-    elif msg_type == int(MsgType.CONFIG_MSG):
-        logger.info("Got a config message")
-        lora_parse_config_msg(payload)
-    elif msg_type == int(MsgType.CONFIG_SET_REQ):
-        logger.info("Got a config set request")
-        lora_parse_config_set_req(payload)
-    elif msg_type == int(MsgType.SERVICE_REQ):
-        logger.info("Got a service request")
-        lora_parse_servive_req(payload)
-    else:
+    handler = LORA_MSG_HANDLERS.get(msg_type)
+    if handler is None:
         logger.info(f"Got the unsupported message type {msg_type}")
+        return
+
+    description, parse = handler
+    logger.info(f"Got a {description}")
+    parse(payload)
 
 
 def lora_parse_ping_req(payload):
-    logger.debug(bytes.hex(payload.message, " "))
+    log_debug_message(payload.message)
     lora_send_ping_msg(payload.header_from, payload.rssi)
 
 
 def lora_parse_ping_msg(payload):
-    logger.debug(bytes.hex(payload.message, " "))
+    log_debug_message(payload.message)
     msg_decoded = PingMsg(payload.message)
-    logger.debug(msg_decoded.to_json())
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(msg_decoded.to_json())
 
 
 def lora_parse_discovery_req(payload):
-    logger.debug(bytes.hex(payload.message, " "))
+    log_debug_message(payload.message)
 
 
 def lora_parse_discovery_msg(payload):
-    logger.debug(bytes.hex(payload.message, " "))
-    msg_decoded = DiscoveryMsg.from_bytes(payload.message)
-    logger.debug(jsonpickle.encode(msg_decoded, unpicklable=False))
-    msg_decoded_json = msg_decoded.to_json()
+    log_debug_message(payload.message)
+    msg_decoded = DiscoveryMsg.from_bytes(memoryview(payload.message))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(msg_decoded.to_json())
 
     modified = False
-    found = False
-    for i, item in enumerate(discovery_msgs):
-        if item.entity_id == msg_decoded.entity_id:
-            found = True
-            if item != msg_decoded:
-                logger.warning(
-                    f"Entity {msg_decoded.entity_id} is different than in discovery_msgs"
-                )
-                discovery_msgs[i] = msg_decoded
-                modified = True
-            else:
-                logger.debug(
-                    f"Entity {msg_decoded.entity_id} is same as in discovery_msgs"
-                )
-
-    if not found:
+    item = discovery_msgs.get(msg_decoded.entity_id)
+    if item is None:
         logger.warning(f"Entity {msg_decoded.entity_id} not in discovery_msgs")
-        discovery_msgs.append(msg_decoded)
         modified = True
+    elif item != msg_decoded:
+        logger.warning(
+            f"Entity {msg_decoded.entity_id} is different than in discovery_msgs"
+        )
+        modified = True
+    else:
+        logger.debug(f"Entity {msg_decoded.entity_id} is same as in discovery_msgs")
 
     if modified:
-        with open("discovery.json", mode="w") as f:
-            f.write(jsonpickle.encode(discovery_msgs, unpicklable=False))
+        discovery_msgs[msg_decoded.entity_id] = msg_decoded
+        discovery_payloads.pop((payload.header_from, msg_decoded.entity_id), None)
+        lora_schedule_save_discovery()
 
-    mqtt_discovery_announce_entity(devices[str(payload.header_from)], msg_decoded)
+    mqtt_discovery_announce_entity(
+        payload.header_from, devices[payload.header_from], msg_decoded
+    )
 
 
 def lora_parse_value_req(payload):
-    logger.debug(bytes.hex(payload.message, " "))
+    log_debug_message(payload.message)
     logger.warning("Unexpected value request message")
 
 
 def lora_parse_value_msg(payload):
-    logger.debug(bytes.hex(payload.message, " "))
-    msg_decoded = ValueMsg(payload.message)
-    logger.debug(jsonpickle.encode(msg_decoded, unpicklable=False))
+    log_debug_message(payload.message)
+    msg_decoded = ValueMsg(memoryview(payload.message))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            orjson.dumps([item._asdict() for item in msg_decoded.value_items]).decode()
+        )
 
     values = dict()
-    device = devices[str(payload.header_from)]
+    device = devices[payload.header_from]
     for value_item in msg_decoded.value_items:
-        found = False
-        for disc_item in discovery_msgs:
-            if disc_item.entity_id == value_item.entity_id:
-                found = True
-                entity_name = device["entities"][str(value_item.entity_id)].lower()
-
-                if disc_item.component == "cover":
-                    values[entity_name] = Cover.state[value_item.value]
-                elif disc_item.component == "binary_sensor":
-                    values[entity_name] = (
-                        "OFF" if Cover.state[value_item.value] == 0 else "ON"
-                    )
-                else:
-                    if disc_item.signed and (value_item.value & 0x80000000):
-                        value_item.value = -0x100000000 + value_item.value
-                    if disc_item.precision > 0:
-                        value_item.value /= 10**disc_item.precision
-                    values[entity_name] = value_item.value
-
-        if not found:
+        disc_item = discovery_msgs.get(value_item.entity_id)
+        if disc_item is None:
             logger.warning(
                 f"Could not find entity {value_item.entity_id} in discovery_msgs"
             )
+            continue
+
+        state_key = device["_state_keys"][value_item.entity_id]
+        values[state_key] = disc_item.decode_state(value_item.value)
 
     if values:
-        state_topic = (
-            f"{config['MQTT'].get('base_topic')}/{device['name'].lower()}/state"
-        )
-        logger.info(f"Publishing to {state_topic} ...")
-        logger.debug(json.dumps(values))
-
-        msg_info = mqtt_client.publish(
-            state_topic,
-            payload=json.dumps(values, separators=(",", ":")),
-            qos=1,
-            retain=False,
-        )
-        msg_info.wait_for_publish(timeout=5)
-        if msg_info.rc == mqtt.MQTT_ERR_SUCCESS:
-            logger.info("...done")
-        elif msg_info.rc == mqtt.MQTT_ERR_NO_CONN:
-            logger.error("...no connection")
-        elif msg_info.rc == mqtt.MQTT_ERR_QUEUE_SIZE:
-            logger.error("...send queue is full")
-        else:
-            logger.error("...unknown error")
+        mqtt_schedule_publish_values(payload.header_from, values)
 
 
 def lora_parse_config_req(payload):
-    logger.debug(bytes.hex(payload.message, " "))
+    log_debug_message(payload.message)
     logger.warning("Unexpected config request message")
 
 
 def lora_parse_config_msg(payload):
-    logger.debug(bytes.hex(payload.message, " "))
+    log_debug_message(payload.message)
 
 
 def lora_parse_config_set_req(payload):
-    logger.debug(bytes.hex(payload.message, " "))
+    log_debug_message(payload.message)
     logger.warning("Unexpected config set request message")
 
 
 def lora_parse_servive_req(payload):
-    logger.debug(bytes.hex(payload.message, " "))
+    log_debug_message(payload.message)
     logger.warning("Unexpected service request message")
 
 
+# msg_type: (description, parse function)
+LORA_MSG_HANDLERS = {
+    MsgType.PING_REQ: ("ping request", lora_parse_ping_req),
+    MsgType.PING_MSG: ("ping message", lora_parse_ping_msg),
+    MsgType.DISCOVERY_REQ: ("discovery request", lora_parse_discovery_req),
+    MsgType.DISCOVERY_MSG: ("discovery message", lora_parse_discovery_msg),
+    MsgType.VALUE_REQ: ("value request", lora_parse_value_req),
+    MsgType.VALUE_MSG: ("value message", lora_parse_value_msg),
+    MsgType.CONFIG_REQ: ("config request", lora_parse_config_req),
+    MsgType.CONFIG_MSG: ("config message", lora_parse_config_msg),
+    MsgType.CONFIG_SET_REQ: ("config set request", lora_parse_config_set_req),
+    MsgType.SERVICE_REQ: ("service request", lora_parse_servive_req),
+}
+
+
 def lora_init():
     """
     Use chip select 1. GPIO pin 5 will be used for interrupts and set reset pin to 25
@@ -544,7 +793,7 @@ def lora_send_hello():
     Send a message to a recipient device with address 10
     Retry sending the message twice if we don't get an  acknowledgment from the recipient
     """
-    message = "Hello there!"
+    message = b"Hello there!"
     status = lora.send_to_wait(message, 10, retries=0)
 
     if status is True:
@@ -581,7 +830,7 @@ def lora_send_ping_msg(address: int, rssi: int) -> None:
         logger.error(f"Rssi value {rssi} is invalid")
         return
 
-    if lora.send_to_wait(struct.pack("!h", rssi), address, MsgType.PING_REQ):
+    if lora.send_to_wait(RSSI_PACKER.pack(rssi), address, MsgType.PING_REQ):
         logger.info("LoRa Ping response message sent!")
     else:
         logger.warning("No ack from LoRa recipient")
@@ -600,7 +849,9 @@ def lora_send_discovery_req(address: int, entity_id: int) -> None:
         logger.error(f"Entity ID {entity_id} is invalid")
         return
 
-    if lora.send_to_wait(struct.pack("!B", entity_id), address, MsgType.DISCOVERY_REQ):
+    if lora.send_to_wait(
+        ENTITY_ID_PACKER.pack(entity_id), address, MsgType.DISCOVERY_REQ
+    ):
         logger.info("LoRa Discovery request message sent!")
     else:
         logger.warning("No ack from LoRa recipient")
@@ -619,7 +870,7 @@ def lora_send_config_req(address: int, entity_id: int) -> None:
         logger.error(f"Entity ID {entity_id} is invalid")
         return
 
-    if lora.send_to_wait(struct.pack("!B", entity_id), address, MsgType.CONFIG_REQ):
+    if lora.send_to_wait(ENTITY_ID_PACKER.pack(entity_id), address, MsgType.CONFIG_REQ):
         logger.info("LoRa Config request message sent!")
     else:
         logger.warning("No ack from LoRa recipient")
@@ -658,7 +909,7 @@ def lora_send_service_req(address: int, entity_id: int, service: int) -> None:
         return
 
     if lora.send_to_wait(
-        struct.pack("!BB", entity_id, service), address, MsgType.SERVICE_REQ
+        SERVICE_REQ_PACKER.pack(entity_id, service), address, MsgType.SERVICE_REQ
     ):
         logger.info("LoRa Service request message sent!")
     else:
@@ -721,40 +972,51 @@ def cmd_parse(line: str):
                 logger.setLevel(logging.DEBUG)
 
 
+def on_signal(signum, frame):
+    logger.info(f"Received {signal.Signals(signum).name}, shutting down")
+    shutdown_event.set()
+
+
 def main():
-    jsonpickle.set_encoder_options("json", indent=2)
     parsed_args = parse_arguments()
     print_intro()
 
     load_configuration(parsed_args.config)
     check_configuration()
 
+    if not parsed_args.interactive:
+        # Installed before connecting, so a stop during startup still shuts down cleanly
+        signal.signal(signal.SIGTERM, on_signal)
+        signal.signal(signal.SIGINT, on_signal)
+
     load_devices(parsed_args.devices)
 
     lora_load_discovery()
+    atexit.register(lora_flush_discovery)
     lora_init()
 
     mqtt_connect()
+    mqtt_client.loop_start()
+    threading.Thread(target=mqtt_publisher_loop, name="publisher", daemon=True).start()
     mqtt_discovery_announce_all()
 
     lora_send_ping_req(1)
 
     logger.info("Initialization complete, starting MQTT publish loop")
 
-    print(parsed_args)
-
     if not parsed_args.interactive:
-        logger.info("loop_forever()")
-        mqtt_client.loop_forever()
+        logger.info("Running MQTT network loop in background")
+        shutdown_event.wait()
     else:
-        logger.info("loop_start()")
-        mqtt_client.loop_start()
         in_line = ""
         while in_line != "exit":
             in_line = input()
             cmd_parse(in_line)
 
-        mqtt_client.loop_stop()
+    mqtt_flush_pending_values()
+    mqtt_drain_publish_queue(PUBLISH_DRAIN_TIMEOUT)
+    mqtt_client.disconnect()
+    mqtt_client.loop_stop()
 
 
 if __name__ == "__main__":
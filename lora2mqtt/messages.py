@@ -1,6 +1,7 @@
 from enum import IntEnum
+from typing import NamedTuple
 import struct
-import json
+import orjson
 
 
 class Cover:
@@ -118,6 +119,14 @@ class Size:
     value = (1, 2, 4, 0)
 
 
+class Flags:
+    # (signed, size, precision) for every value of a flags byte
+    decoded = tuple(
+        ((flags & 0x10) != 0, Size.value[(flags & 0x0C) >> 2], flags & 0x03)
+        for flags in range(256)
+    )
+
+
 class MsgType(IntEnum):
     PING_REQ = 0
     PING_MSG = 1
@@ -132,14 +141,25 @@ class MsgType(IntEnum):
 
 
 class PingMsg:
+    __slots__ = ("rssi",)
+
+    # msg_type, rssi
     def __init__(self, msg: bytes) -> None:
-        self.rssi = struct.unpack("!Bb", msg)[1]
+        # Sign-extend the single rssi byte
+        self.rssi = (msg[1] ^ 0x80) - 0x80
+
+    def to_dict(self) -> dict:
+        return {"rssi": self.rssi}
 
     def to_json(self):
-        return json.dumps(self, default=lambda self: self.__dict__)
+        return orjson.dumps(self.to_dict()).decode()
 
 
 class ConfigItem:
+    __slots__ = ("id", "unit", "signed", "size", "precision")
+    # id, unit, flags
+    packer = struct.Struct("!BBB")
+
     def __init__(
         self, id: int, unit: str, signed: bool, size: int, precision: int
     ) -> None:
@@ -150,34 +170,61 @@ class ConfigItem:
         self.precision = precision
 
     @classmethod
-    def from_bytes(cls, msg: bytes) -> None:
-        id = msg[0]
-        unit = Unit.name[msg[1]]
-        signed = (msg[2] & 0x10) != 0
-        size = Size.value[(msg[2] & 0x0C) >> 2]
-        precision = int(msg[2] & 0x03)
-        return cls(id, unit, signed, size, precision)
+    def from_bytes(cls, msg: bytes, offset: int = 0):
+        return cls.from_fields(*cls.packer.unpack_from(msg, offset))
+
+    @classmethod
+    def from_fields(cls, id: int, unit_id: int, flags: int):
+        return cls(id, Unit.name[unit_id], *Flags.decoded[flags])
 
     @classmethod
     def from_dict(cls, msg: dict):
         return cls(msg["id"], msg["unit"], msg["signed"], msg["size"], msg["precision"])
 
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "unit": self.unit,
+            "signed": self.signed,
+            "size": self.size,
+            "precision": self.precision,
+        }
+
     def to_json(self):
-        return json.dumps(self, default=lambda self: self.__dict__)
+        return orjson.dumps(self.to_dict()).decode()
+
+    def _key(self) -> tuple:
+        return (self.id, self.unit, self.signed, self.size, self.precision)
 
     def __eq__(self, other) -> bool:
         if isinstance(other, ConfigItem):
-            return (
-                self.id == other.id
-                and self.unit == other.unit
-                and self.signed == other.signed
-                and self.size == other.size
-                and self.precision == other.precision
-            )
+            return self._key() == other._key()
         return False
 
 
 class DiscoveryMsg:
+    __slots__ = (
+        "entity_id",
+        "component",
+        "device_class",
+        "unit",
+        "signed",
+        "size",
+        "precision",
+        "config_items",
+        "_component_id",
+        "_sign_mask",
+        "_divisor",
+    )
+    # msg_type, entity_id, component, device_class, unit, flags, num_cfg_items
+    packer = struct.Struct("!xBBBBBB")
+    # Device class names of each component, in Component.name order
+    deviceClassNames = (
+        BinarySensor.deviceClassName,
+        Sensor.deviceClassName,
+        Cover.deviceClassName,
+    )
+
     def __init__(
         self,
         entity_id: int,
@@ -197,39 +244,37 @@ class DiscoveryMsg:
         self.size = size
         self.precision = precision
         self.config_items = config_items
+        # Precomputed for decode_value()
+        self._sign_mask = 0x80000000 if signed else 0
+        self._divisor = 10**precision
+        # Precomputed for decode_state(), None for an unknown component
+        self._component_id = (
+            Component.name.index(component) if component in Component.name else None
+        )
 
     @classmethod
     def from_bytes(cls, msg: bytes):
-        entity_id = msg[1]
-        component = Component.name[msg[2]]
-        if component == Component.name[0]:
-            device_class = BinarySensor.deviceClassName[msg[3]]
-        elif component == Component.name[1]:
-            device_class = Sensor.deviceClassName[msg[3]]
-        elif component == Component.name[2]:
-            device_class = Cover.deviceClassName[msg[3]]
-        else:
-            device_class = None
-        unit = Unit.name[msg[4]]
-        signed = (msg[5] & 0x10) != 0
-        size = Size.value[(msg[5] & 0x0C) >> 2]
-        precision = int(msg[5] & 0x03)
-        num_cfg_items = msg[6]
-        if num_cfg_items > 0:
-            config_items = list()
-            offset = 7
-            for i in range(num_cfg_items):
-                config_items.append(ConfigItem.from_bytes(msg[offset : offset + 3]))
-                offset += 3
+        (
+            entity_id,
+            component_id,
+            device_class_id,
+            unit_id,
+            flags,
+            num_cfg_items,
+        ) = cls.packer.unpack_from(msg)
+        offset = cls.packer.size
+        end = offset + num_cfg_items * ConfigItem.packer.size
+        config_items = [
+            ConfigItem.from_fields(*fields)
+            for fields in ConfigItem.packer.iter_unpack(memoryview(msg)[offset:end])
+        ]
 
         return cls(
             entity_id,
-            component,
-            device_class,
-            unit,
-            signed,
-            size,
-            precision,
+            Component.name[component_id],
+            cls.deviceClassNames[component_id][device_class_id],
+            Unit.name[unit_id],
+            *Flags.decoded[flags],
             config_items,
         )
 
@@ -243,38 +288,76 @@ class DiscoveryMsg:
             msg["signed"],
             msg["size"],
             msg["precision"],
-            msg["config_items"],
+            [ConfigItem.from_dict(item) for item in msg["config_items"]],
         )
 
+    def to_dict(self) -> dict:
+        return {
+            "entity_id": self.entity_id,
+            "component": self.component,
+            "device_class": self.device_class,
+            "unit": self.unit,
+            "signed": self.signed,
+            "size": self.size,
+            "precision": self.precision,
+            "config_items": [item.to_dict() for item in self.config_items],
+        }
+
     def to_json(self):
-        return json.dumps(self, default=lambda self: self.__dict__)
+        return orjson.dumps(self.to_dict()).decode()
+
+    def decode_value(self, value: int):
+        """
+        Decode a raw unsigned 32-bit value of this entity to its signed and
+        scaled value.
+        """
+        # Sign-extends the value when signed, a no-op when the mask is 0
+        value = (value ^ self._sign_mask) - self._sign_mask
+        if self._divisor != 1:
+            value /= self._divisor
+        return value
+
+    def decode_state(self, value: int):
+        """
+        Convert a raw value of this entity to the state published to MQTT.
+        """
+        if self._component_id == 0:  # binary_sensor
+            return "OFF" if value == 0 else "ON"
+        if self._component_id == 2:  # cover
+            return Cover.state[value]
+        return self.decode_value(value)
+
+    def _key(self) -> tuple:
+        # config_items are not compared
+        return (
+            self.entity_id,
+            self.component,
+            self.device_class,
+            self.unit,
+            self.signed,
+            self.size,
+            self.precision,
+        )
 
     def __eq__(self, other):
         if isinstance(other, DiscoveryMsg):
-            return (
-                self.entity_id == other.entity_id
-                and self.component == other.component
-                and self.device_class == other.device_class
-                and self.unit == other.unit
-                and self.signed == other.signed
-                and self.size == other.size
-                and self.precision == other.precision
-                #   and
-                # self.config_items == other.config_items
-            )
+            return self._key() == other._key()
         return False
 
 
-class ValueItem:
-    def __init__(self, msg: bytes) -> None:
-        self.entity_id, self.value = struct.unpack("!BI", msg)
+class ValueItem(NamedTuple):
+    entity_id: int
+    value: int
+
+    packer = struct.Struct("!BI")
 
 
 class ValueMsg:
+    __slots__ = ("num_entities", "value_items")
+
     def __init__(self, msg: bytes) -> None:
         self.num_entities = msg[1]
-        self.value_items = list()
-        offset = 2
-        for i in range(self.num_entities):
-            self.value_items.append(ValueItem(msg[offset : offset + 5]))
-            offset += 5
+        end = 2 + self.num_entities * ValueItem.packer.size
+        self.value_items = list(
+            map(ValueItem._make, ValueItem.packer.iter_unpack(msg[2:end]))
+        )
@@ -1,3 +1,5 @@
+import pytest
+
 from lora2mqtt import lora2mqtt
 
 
@@ -7,7 +9,7 @@ def reset_target():
 
 
 def load_configuration():
-    lora2mqtt.load_configuration("tests/unit/fixtures")
+    lora2mqtt.load_configuration("tests/unit/fixtures/config.ini")
 
 
 def test_load_configuration():
@@ -15,3 +17,28 @@ def test_load_configuration():
     load_configuration()
     assert lora2mqtt.config is not None
     assert lora2mqtt.config["MQTT"]["hostname"] == "localhost"
+
+
+def test_load_configuration_defaults():
+    reset_target()
+    load_configuration()
+    assert lora2mqtt.config["Daemon"]["enabled"] == "True"
+    assert lora2mqtt.config["Daemon"]["period"] == "300"
+    assert lora2mqtt.config["MQTT"]["discovery_qos"] == "1"
+
+
+def test_load_configuration_topic_settings():
+    reset_target()
+    load_configuration()
+    assert lora2mqtt.base_topic == "lora2mqtt"
+    assert lora2mqtt.discovery_prefix == "homeassistant"
+    assert lora2mqtt.discovery_qos == 1
+
+
+def test_check_configuration_discovery_qos(monkeypatch):
+    reset_target()
+    load_configuration()
+    lora2mqtt.check_configuration()
+    monkeypatch.setattr(lora2mqtt, "discovery_qos", 3)
+    with pytest.raises(SystemExit):
+        lora2mqtt.check_configuration()
@@ -0,0 +1,34 @@
+import orjson
+
+from lora2mqtt import lora2mqtt
+
+
+def set_discovery(monkeypatch, tmp_path):
+    file_path = tmp_path / "discovery.json"
+    monkeypatch.setattr(lora2mqtt, "DISCOVERY_FILE_PATH", str(file_path))
+    monkeypatch.setattr(
+        lora2mqtt,
+        "discovery_msgs",
+        {1: lora2mqtt.DiscoveryMsg(1, "sensor", "temperature", "°C", True, 4, 1, [])},
+    )
+    return file_path
+
+
+def test_save_discovery_replaces_file(monkeypatch, tmp_path):
+    file_path = set_discovery(monkeypatch, tmp_path)
+    file_path.write_bytes(b"[]")
+    lora2mqtt.lora_save_discovery()
+    assert orjson.loads(file_path.read_bytes()) == [
+        lora2mqtt.discovery_msgs[1].to_dict()
+    ]
+    assert list(tmp_path.iterdir()) == [file_path]
+
+
+def test_flush_discovery_saves_pending_changes(monkeypatch, tmp_path):
+    file_path = set_discovery(monkeypatch, tmp_path)
+    lora2mqtt.lora_schedule_save_discovery()
+    timer = lora2mqtt.discovery_save_timer
+    lora2mqtt.lora_flush_discovery()
+    assert timer.finished.is_set()
+    assert lora2mqtt.discovery_save_timer is None
+    assert file_path.exists()
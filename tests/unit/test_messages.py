@@ -0,0 +1,86 @@
+from lora2mqtt.messages import ConfigItem, DiscoveryMsg, PingMsg, ValueMsg
+
+
+def discovery_msg(signed, precision):
+    return DiscoveryMsg(1, "sensor", "temperature", "°C", signed, 4, precision, [])
+
+
+def test_decode_value_unsigned():
+    assert discovery_msg(False, 0).decode_value(0xFFFFFFF6) == 0xFFFFFFF6
+
+
+def test_decode_value_signed():
+    assert discovery_msg(True, 0).decode_value(0xFFFFFFF6) == -10
+    assert discovery_msg(True, 0).decode_value(10) == 10
+
+
+def test_decode_value_precision():
+    assert discovery_msg(True, 1).decode_value(215) == 21.5
+    assert discovery_msg(True, 2).decode_value(0xFFFFFFFF) == -0.01
+
+
+def test_decode_value_keeps_int_without_precision():
+    assert isinstance(discovery_msg(False, 0).decode_value(21), int)
+
+
+def test_value_msg():
+    msg = bytes([5, 2, 1, 0, 0, 0, 215, 5, 0xFF, 0xFF, 0xFF, 0xF6])
+    value_items = ValueMsg(msg).value_items
+    assert [(item.entity_id, item.value) for item in value_items] == [
+        (1, 215),
+        (5, 0xFFFFFFF6),
+    ]
+
+
+def test_value_msg_from_memoryview():
+    msg = memoryview(bytes([5, 1, 3, 0, 0, 1, 0]))
+    value_items = ValueMsg(msg).value_items
+    assert [(item.entity_id, item.value) for item in value_items] == [(3, 256)]
+
+
+def test_decode_state():
+    binary_sensor = DiscoveryMsg(5, "binary_sensor", "presence", "", False, 1, 0, [])
+    assert binary_sensor.decode_state(0) == "OFF"
+    assert binary_sensor.decode_state(1) == "ON"
+    cover = DiscoveryMsg(0, "cover", "garage", "", False, 1, 0, [])
+    assert cover.decode_state(1) == "open"
+    assert discovery_msg(True, 1).decode_state(0xFFFFFFF6) == -1.0
+
+
+def test_discovery_msg_from_bytes():
+    msg = bytes([3, 1, 1, 39, 1, 0x10 | 0x08 | 0x01, 1, 7, 1, 0x11])
+    disc = DiscoveryMsg.from_bytes(memoryview(msg))
+    assert disc == DiscoveryMsg(1, "sensor", "temperature", "°C", True, 4, 1, [])
+    assert disc.config_items == [ConfigItem(7, "°C", True, 1, 1)]
+
+
+def test_discovery_msg_from_bytes_without_config_items():
+    msg = bytes([3, 5, 0, 18, 0, 0, 0])
+    disc = DiscoveryMsg.from_bytes(msg)
+    assert disc == DiscoveryMsg(5, "binary_sensor", "presence", "", False, 1, 0, [])
+    assert disc.config_items == []
+
+
+def test_ping_msg():
+    assert PingMsg(bytes([1, 0xD8])).rssi == -40
+
+
+def test_ping_msg_to_json():
+    assert PingMsg(bytes([1, 0xD8])).to_json() == '{"rssi":-40}'
+
+
+def test_config_item_from_bytes():
+    assert ConfigItem.from_bytes(bytes([2, 4, 0x06])) == ConfigItem(2, "%", False, 2, 2)
+
+
+def test_discovery_msg_eq_ignores_config_items():
+    config_item = ConfigItem(7, "°C", True, 1, 1)
+    assert discovery_msg(True, 1) == DiscoveryMsg(
+        1, "sensor", "temperature", "°C", True, 4, 1, [config_item]
+    )
+    assert discovery_msg(True, 1) != discovery_msg(True, 2)
+
+
+def test_config_item_from_bytes_offset():
+    msg = bytes([3, 1, 1, 39, 1, 0x11, 1, 2, 4, 0x06])
+    assert ConfigItem.from_bytes(msg, 7) == ConfigItem(2, "%", False, 2, 2)
@@ -1,3 +1,5 @@
+import queue
+
 from lora2mqtt import lora2mqtt
 
 
@@ -7,7 +9,7 @@ def reset_target():
 
 
 def load_configuration():
-    lora2mqtt.load_configuration("tests/unit/fixtures")
+    lora2mqtt.load_configuration("tests/unit/fixtures/config.ini")
 
 
 def test_load_configuration():
@@ -21,3 +23,49 @@ def test_mqtt_connect():
     reset_target()
     load_configuration()
     lora2mqtt.mqtt_connect()
+
+
+def test_mqtt_republish_only_on_reconnect(monkeypatch):
+    republished = []
+    monkeypatch.setattr(
+        lora2mqtt, "mqtt_discovery_republish", lambda: republished.append(True)
+    )
+    monkeypatch.setattr(lora2mqtt, "mqtt_connected_once", False)
+    lora2mqtt.on_mqtt_connect(lora2mqtt.mqtt_client, None, {}, 0)
+    assert republished == []
+    lora2mqtt.on_mqtt_connect(lora2mqtt.mqtt_client, None, {}, 0)
+    assert republished == [True]
+
+
+def test_mqtt_flush_pending_values(monkeypatch):
+    monkeypatch.setattr(
+        lora2mqtt, "devices", {1: {"_state_topic": "lora2mqtt/d/state"}}
+    )
+    monkeypatch.setattr(lora2mqtt, "publish_queue", queue.Queue())
+    lora2mqtt.mqtt_schedule_publish_values(1, {"temperature": 21.5})
+    timer = lora2mqtt.pending_values_timer
+    lora2mqtt.mqtt_flush_pending_values()
+    assert timer.finished.is_set()
+    assert lora2mqtt.publish_queue.get_nowait() == (
+        "lora2mqtt/d/state",
+        b'{"temperature":21.5}',
+    )
+
+
+def test_mqtt_drain_publish_queue_is_bounded(monkeypatch):
+    monkeypatch.setattr(lora2mqtt, "publish_queue", queue.Queue())
+    lora2mqtt.publish_queue.put(("lora2mqtt/d/state", b"{}"))
+    lora2mqtt.mqtt_drain_publish_queue(0.1)
+    assert lora2mqtt.publish_queue.unfinished_tasks == 1
+
+
+def test_mqtt_discovery_inflight_limit_counts_announced_entities(monkeypatch):
+    limits = []
+    monkeypatch.setattr(
+        lora2mqtt.mqtt_client, "max_inflight_messages_set", limits.append
+    )
+    monkeypatch.setattr(lora2mqtt, "mqtt_discovery_announce_device", lambda id, d: [])
+    monkeypatch.setattr(lora2mqtt, "devices", {0: {}, 1: {}, 2: {}})
+    monkeypatch.setattr(lora2mqtt, "discovery_msgs", dict.fromkeys(range(25)))
+    lora2mqtt.mqtt_discovery_announce_all()
+    assert limits == [25]